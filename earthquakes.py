@@ -2,56 +2,244 @@
 # over the Internet.
 # However, we will use a more powerful and simpler library called requests.
 # This is external library that you may need to install first.
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+# A session keeps the connection to the server open between requests,
+# so we don't pay for a new connection (and TLS handshake) every time.
+# requests doesn't promise that a Session is safe to share between threads,
+# so each thread that downloads data gets a session of its own.
+_THREAD_STATE = threading.local()
 
-def get_data():
-    # With requests, we can ask the web service for the data.
-    # Can you understand the parameters we are passing here?
-    response = requests.get(
-        "http://earthquake.usgs.gov/fdsnws/event/1/query.geojson",
-        params={
-            'starttime': "2000-01-01",
-            "maxlatitude": "58.723",
-            "minlatitude": "50.008",
-            "maxlongitude": "1.67",
-            "minlongitude": "-9.756",
-            "minmagnitude": "1",
-            "endtime": "2018-10-11",
-            "orderby": "time-asc"}
+
+def _session():
+    """Return the session belonging to the current thread."""
+    session = getattr(_THREAD_STATE, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=4, pool_maxsize=10,
+                        max_retries=Retry(total=3, backoff_factor=0.3))
+        )
+        _THREAD_STATE.session = session
+    return session
+
+
+# The web service that we query for earthquakes.
+_URL = "https://earthquake.usgs.gov/fdsnws/event/1/query.geojson"
+
+# The catalog for a past date range does not change, so we keep a copy of
+# each response on disk and only ask the server again once it is a day old.
+_CACHE_DIR = Path.home() / ".cache" / "usgs"
+_CACHE_MAX_AGE = 24 * 60 * 60
+
+# How many yearly queries to send to the server at the same time.
+_MAX_WORKERS = 8
+
+
+def _cache_paths(params):
+    """Return the paths of the cached body and ETag for a set of parameters."""
+    key = hashlib.blake2b(repr(sorted(params.items())).encode(),
+                          digest_size=16).hexdigest()
+    return (_CACHE_DIR / f"{key}.geojson.gz", _CACHE_DIR / f"{key}.etag")
+
+
+def _discard_cache(body_path, etag_path):
+    """Remove a cache entry, e.g. because it could not be read back."""
+    try:
+        body_path.unlink(missing_ok=True)
+        etag_path.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+
+def _read_cache(body_path, etag_path):
+    """Load a cached response body, or return None if it is missing or bad."""
+    try:
+        return json.loads(gzip.decompress(body_path.read_bytes()))
+    except (OSError, EOFError, zlib.error, ValueError):
+        # A missing, truncated or corrupt file is just a cache miss.
+        _discard_cache(body_path, etag_path)
+        return None
+
+
+def _write_atomically(path, content):
+    """Write bytes to a file so that readers never see it half-written."""
+    with tempfile.NamedTemporaryFile(dir=_CACHE_DIR, delete=False) as tmp:
+        try:
+            tmp.write(content)
+            tmp.close()
+            os.replace(tmp.name, path)
+        except BaseException:
+            # Don't leave a stray temporary file behind in the cache.
+            tmp.close()
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
+
+
+def _write_cache(body_path, etag_path, response):
+    """Save a response body (and its ETag, if any) for later runs."""
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Drop the old ETag first, so it can never be paired with a newer body.
+        etag_path.unlink(missing_ok=True)
+        _write_atomically(body_path, gzip.compress(response.content))
+        etag = response.headers.get("ETag")
+        if etag:
+            _write_atomically(etag_path, etag.encode())
+    except OSError:
+        # The cache is only a shortcut: if we can't write it (e.g. the home
+        # directory is read-only), carry on with the data we downloaded.
+        pass
+
+
+def _download(params, etag=None):
+    """Send one query to the web service."""
+    # requests already asks for a compressed response (gzip and deflate,
+    # plus brotli or zstandard when those packages are installed), so we
+    # only need to say which format we want.
+    headers = {"Accept": "application/geo+json"}
+    if etag is not None:
+        # The server will answer "304 Not Modified" if our copy is current.
+        headers["If-None-Match"] = etag
+    return _session().get(
+        _URL,
+        params=params,
+        headers=headers,
+        timeout=(3.05, 30)
     )
 
+
+def _fetch(params):
+    """Download (or load from the cache) the response for one query."""
+    body_path, etag_path = _cache_paths(params)
+    etag = None
+    if body_path.exists():
+        if time.time() - body_path.stat().st_mtime < _CACHE_MAX_AGE:
+            data = _read_cache(body_path, etag_path)
+            if data is not None:
+                return data
+        elif etag_path.exists():
+            etag = etag_path.read_text()
+
+    response = _download(params, etag)
+    if response.status_code == 304:
+        data = _read_cache(body_path, etag_path)
+        if data is not None:
+            try:
+                # Mark our copy as fresh again.
+                body_path.touch()
+            except OSError:
+                pass
+            return data
+        # Our copy went missing or bad since we checked; fetch it afresh.
+        response = _download(params)
+
     # The response we get back is an object with several fields.
-    # The actual contents we care about are in its text field:
-    text = response.text
-    # To understand the structure of this text, you may want to save it
-    # to a file and open it in VS Code or a browser.
+    # The actual contents we care about are in its body, which is JSON.
+    # To understand the structure of this data, you may want to save
+    # response.text to a file and open it in VS Code or a browser.
     # See the README file for more information.
-    ...
+    response.raise_for_status()
+    _write_cache(body_path, etag_path, response)
+
+    # If the server doesn't name a charset, response.text would first run
+    # charset detection over the whole body; response.json() instead works
+    # out the UTF encoding from the first few bytes. When a charset is
+    # given, the two end up doing the same work.
+    return response.json()
+
+
+def _yearly_windows(starttime, endtime):
+    """Split a date range into (start, end) windows of at most one year."""
+    first_year, last_year = int(starttime[:4]), int(endtime[:4])
+    new_years = [f"{year}-01-01"
+                 for year in range(first_year + 1, last_year + 1)]
+    bounds = [starttime] + new_years + [endtime]
+    # Skip the empty window we'd get if the range ends on the 1st of January.
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if start != end]
+
+
+def get_data():
+    # With requests, we can ask the web service for the data.
+    # Can you understand the parameters we are passing here?
+    params = {
+        'starttime': "2000-01-01",
+        "maxlatitude": "58.723",
+        "minlatitude": "50.008",
+        "maxlongitude": "1.67",
+        "minlongitude": "-9.756",
+        "minmagnitude": "1",
+        "endtime": "2018-10-11",
+        "orderby": "time-asc"}
+
+    # The service caps how many events one query can return, so we ask for
+    # one year at a time. The queries run in parallel, one thread per query.
+    windows = _yearly_windows(params['starttime'], params['endtime'])
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        chunks = list(executor.map(
+            lambda window: _fetch(dict(params, starttime=window[0],
+                                       endtime=window[1])),
+            windows))
+
+    # Both ends of a window are inclusive, so an event exactly on a year
+    # boundary is returned twice; keep only its first copy.
+    seen = set()
+    features = []
+    for chunk in chunks:
+        for feature in chunk['features']:
+            if feature['id'] not in seen:
+                seen.add(feature['id'])
+                features.append(feature)
+
+    # Each chunk's metadata describes its own window, so describe the
+    # whole query instead.
+    full_url = requests.Request("GET", _URL, params=params).prepare().url
+    metadata = dict(chunks[0]['metadata'], url=full_url, count=len(features))
+    return {'type': "FeatureCollection",
+            'metadata': metadata,
+            'features': features}
 
-    # We need to interpret the text to get values that we can work with.
-    # What format is the text in? How can we load the values?
-    return ...
 
 def count_earthquakes(data):
     """Get the total number of earthquakes in the response."""
-    return ...
+    return data['metadata']['count']
 
 
 def get_magnitude(earthquake):
     """Retrive the magnitude of an earthquake item."""
-    return ...
+    return earthquake['properties']['mag']
 
 
 def get_location(earthquake):
     """Retrieve the latitude and longitude of an earthquake item."""
     # There are three coordinates, but we don't care about the third (altitude)
-    return ...
+    longitude, latitude = earthquake['geometry']['coordinates'][:2]
+    return latitude, longitude
 
 
 def get_maximum(data):
     """Get the magnitude and location of the strongest earthquake in the data."""
-    ...
+    # max() with a key keeps the loop and comparisons out of Python bytecode,
+    # but get_magnitude is still called (in Python) once per feature.
+    # Every feature has a magnitude: the query asks for minmagnitude=1, so
+    # the service never returns one whose 'mag' is None.
+    strongest = max(data['features'], key=get_magnitude)
+    return get_magnitude(strongest), get_location(strongest)
 
 
 # With all the above functions defined, we can now call them and get the result